@@ -1,214 +1,308 @@
 import argparse
 import datetime
+import itertools
+import json
 import os
+import sqlite3
+import sys
 import textwrap
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import requests
 from plexapi import CONFIG
-from plexapi.exceptions import BadRequest
 from plexapi.myplex import MyPlexAccount
 from plexapi.utils import getMyPlexAccount
 
+from plex_watch_history.api import (
+    GET_WATCH_HISTORY_IDS_QUERY,
+    GET_WATCH_HISTORY_QUERY,
+    MAX_RETRIES,
+    PAGE_SIZE,
+    REMOVE_BATCH_SIZE,
+    REMOVE_RATE,
+    REMOVE_WORKERS,
+    SESSION,
+    Action,
+    Entry,
+    RateLimiter,
+    classify_error,
+    flatten_entry,
+    get_watch_history,
+    get_watch_history_page,
+    https_adapter,
+    remove_watch_history_batch,
+    warm_up_connection,
+    watch_history_params,
+)
+from plex_watch_history.format import plex_format_entry
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "plex_watch_history",
+)
+
+# Number of listed entries written to stdout at once
+OUTPUT_BATCH_SIZE = 1000
+
+# Seconds added to the wait each time a pass deletes nothing new
+STALL_DELAY = 2
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
 
-COMMUNITY = "https://community.plex.tv/api"
-
-GET_WATCH_HISTORY_QUERY = """\
-query GetWatchHistoryHub(
-  $uuid: ID = ""
-  $first: PaginationInt!
-  $after: String
-  $skipUserState: Boolean = false
-) {
-  user(id: $uuid) {
-    watchHistory(first: $first, after: $after) {
-      nodes {
-        metadataItem {
-          ...itemFields
-        }
-        date
-        id
-      }
-      pageInfo {
-        hasNextPage
-        hasPreviousPage
-        endCursor
-      }
-    }
-  }
-}
-
-fragment itemFields on MetadataItem {
-  id
-  images {
-    coverArt
-    coverPoster
-    thumbnail
-    art
-  }
-  userState @skip(if: $skipUserState) {
-    viewCount
-    viewedLeafCount
-    watchlistedAt
-  }
-  title
-  key
-  type
-  index
-  publicPagesURL
-  parent {
-    ...parentFields
-  }
-  grandparent {
-    ...parentFields
-  }
-  publishedAt
-  leafCount
-  year
-  originallyAvailableAt
-  childCount
-}
-
-fragment parentFields on MetadataItem {
-  index
-  title
-  publishedAt
-  key
-  type
-  images {
-    coverArt
-    coverPoster
-    thumbnail
-    art
-  }
-  userState @skip(if: $skipUserState) {
-    viewCount
-    viewedLeafCount
-    watchlistedAt
-  }
-}
-"""
-
-REMOVE_WATCH_HISTORY_QUERY = """\
-mutation removeActivity($input: RemoveActivityInput!) {
-  removeActivity(input: $input)
-}
-"""
-
-
-def plex_format(item):
-    item_type = item["type"].lower()
-    parent = item["parent"]
-    grandparent = item["grandparent"]
-
-    if item_type == "season":
-        return f"{parent['title']}: Season {item['index']}"
-
-    if item_type == "episode":
-        return (
-            f"{grandparent['title']}: Season {parent['index']}: "
-            f"Episode {item['index']:2d} - {item['title']}"
-        )
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
 
-    return f"{item['title']} ({item['year']})"
+        yield chunk
 
 
-def community_query(account, params):
-    response = account.query(
-        COMMUNITY,
-        json=params,
-        method=account._session.post,
-        headers={"Content-Type": "application/json"},
-    )
+def _list_marker_path(account):
+    return os.path.join(CACHE_DIR, f"list-{account.uuid}.json")
 
-    if False:
-        import json
 
-        print(json.dumps(response, indent=4))
+def load_list_marker(account):
+    try:
+        with open(_list_marker_path(account)) as f:
+            return json.load(f)
 
-    return response
+    except FileNotFoundError:
+        return None
 
 
-def get_watch_history(account, first=100, after=None, user_state=False, all_=True):
-    params = {
-        "query": GET_WATCH_HISTORY_QUERY,
-        "operationName": "GetWatchHistoryHub",
-        "variables": {
-            "uuid": account.uuid,
-            "first": first,
-            "after": after,
-            "skipUserState": not user_state,
-        },
-    }
+def save_list_marker(account, entry):
+    # Write to a temporary file first so an interrupted run can't leave a
+    # truncated marker behind.
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
-    while True:
-        try:
-            response = community_query(account, params)
-            watch_history = response["data"]["user"]["watchHistory"]
-            page_info = watch_history["pageInfo"]
+    path = _list_marker_path(account)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"id": entry.id, "date": entry.date}, f)
 
-            yield from watch_history["nodes"]
+    os.replace(f"{path}.tmp", path)
 
-            if not all_ or not page_info["hasNextPage"]:
-                return
 
-            params["variables"]["after"] = page_info["endCursor"]
+def listed_before(marker):
+    # The history is newest first, so everything from the last entry we
+    # listed onwards has been listed before and there's no need to page
+    # through it.
+    date = datetime.datetime.fromisoformat(marker["date"])
 
-            # Try to avoid API rate limiting
-            time.sleep(3)
+    def reached(entry):
+        return entry.id == marker["id"] or datetime.datetime.fromisoformat(entry.date) < date
 
-        except BadRequest:
-            time.sleep(40)
+    return reached
 
 
-def remove_watch_history(account, item):
-    params = {
-        "query": REMOVE_WATCH_HISTORY_QUERY,
-        "operationName": "removeActivity",
-        "variables": {
-            "input": {
-                "id": item["id"],
-                "type": "WATCH_HISTORY",
-            },
-        },
-    }
+def list_watch_history(account, args):
+    marker = load_list_marker(account) if args.incremental else None
+    until = listed_before(marker) if marker is not None else None
+    newest = None
 
-    response = community_query(account, params)
-    return response["data"]["removeActivity"]
+    history = get_watch_history(account, first=args.page_size, until=until)
 
+    for batch in chunked(history, OUTPUT_BATCH_SIZE):
+        sys.stdout.write("".join(f"{plex_format_entry(entry)}\n" for entry in batch))
 
-def plex_format_entry(entry):
-    date = datetime.datetime.fromisoformat(entry["date"]).strftime("%c")
-    entry = plex_format(entry["metadataItem"])
+        if args.incremental and newest is None:
+            newest = batch[0]
 
-    return f"{date}: {entry}"
+    if args.incremental and newest is not None:
+        save_list_marker(account, newest)
 
 
-def list_watch_history(account):
-    for entry in get_watch_history(account):
-        print(plex_format_entry(entry))
+def open_deleted_cache():
+    # Remembers which entries were already deleted so an interrupted or
+    # repeated delete doesn't send them again while the server catches up.
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
+    cache = sqlite3.connect(os.path.join(CACHE_DIR, "deleted.sqlite"))
+    cache.execute("CREATE TABLE IF NOT EXISTS deleted (id TEXT PRIMARY KEY)")
+    return cache
+
+
+def was_deleted(cache, entry):
+    row = cache.execute("SELECT 1 FROM deleted WHERE id = ?", (entry.id,)).fetchone()
+    return row is not None
+
+
+def delete_order(entry):
+    # Group entries by show, then season and episode, so each batch tends
+    # to touch the same parent items on the server.
+    show = entry.grandparent_title or entry.parent_title or entry.title or ""
+    return (show, entry.parent_index or 0, entry.index or 0)
+
+
+class BatchSize:
+    """Entries per delete request, shared by all the delete workers."""
+
+    def __init__(self, size):
+        self.size = size
+        self.accepted = 0
+        self._lock = threading.Lock()
+
+    def accept(self, size):
+        with self._lock:
+            self.accepted = max(self.accepted, size)
+
+    def shrink(self, size):
+        with self._lock:
+            self.size = min(self.size, size)
 
-def delete_watch_history(account):
-    while True:
-        history = list(get_watch_history(account))
-        if len(history) == 0:
-            break
 
-        print(f"Deleting {len(history)} watch history entries\n")
+def _remove_watch_history_batch(batch, limiter, batch_size):
+    try:
+        removed = remove_watch_history_batch(batch, limiter)
 
-        for entry in history:
-            print(plex_format_entry(entry))
+    except requests.RequestException as e:
+        # The server may not take this many mutations in one request. Once
+        # a batch this big has gone through, the 400 has to be about
+        # something else and splitting won't help.
+        if classify_error(e) is not Action.SKIP or len(batch) <= max(batch_size.accepted, 1):
+            raise
 
+        half = len(batch) // 2
+        removed = _remove_watch_history_batch(batch[:half], limiter, batch_size)
+        removed += _remove_watch_history_batch(batch[half:], limiter, batch_size)
+
+        # Both halves went through, so stick to that size from now on
+        # rather than having every later batch rejected and split again.
+        batch_size.shrink(len(batch) - half)
+        return removed
+
+    batch_size.accept(len(batch))
+    return removed
+
+
+def delete_watch_history(account, args):
+    cache = open_deleted_cache()
+    limiter = RateLimiter(REMOVE_RATE)
+    batch_size = BatchSize(args.batch_size)
+    total = 0
+    stalled = 0
+    stuck = 0
+
+    query = GET_WATCH_HISTORY_IDS_QUERY if args.quiet else GET_WATCH_HISTORY_QUERY
+    params = watch_history_params(account, first=args.page_size, query=query)
+    shrink = True
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
             while True:
-                try:
-                    remove_watch_history(account, entry)
+                # Deleted entries drop out of the history, so the first page
+                # always holds the next entries to delete. Walking the cursor
+                # instead would skip entries as earlier ones disappear from
+                # under it.
+                watch_history = get_watch_history_page(params, shrink)
+                shrink = False
+
+                if args.quiet:
+                    history = [Entry(node["id"]) for node in watch_history["nodes"]]
+                else:
+                    history = [flatten_entry(node) for node in watch_history["nodes"]]
+
+                if len(history) == 0:
+                    break
+
+                pending = [entry for entry in history if not was_deleted(cache, entry)]
+
+                # Nothing new on the page means the earlier deletes didn't stick
+                if len(pending) == 0:
+                    pending = history
+
+                if not args.quiet:
+                    pending.sort(key=delete_order)
+
+                all_removed = True
+                fresh_total = 0
+
+                futures = {
+                    executor.submit(_remove_watch_history_batch, batch, limiter, batch_size): batch
+                    for batch in chunked(pending, batch_size.size)
+                }
+
+                for future in as_completed(futures):
+                    batch = futures[future]
 
-                    # Try to avoid API rate limiting
-                    time.sleep(1)
+                    try:
+                        removed = future.result()
+
+                    except BaseException:
+                        # Don't start on batches that are still queued
+                        for pending_future in futures:
+                            pending_future.cancel()
+
+                        raise
+
+                    # Entries sent again were already listed and counted
+                    fresh = [
+                        entry
+                        for entry, ok in zip(batch, removed)
+                        if ok and not was_deleted(cache, entry)
+                    ]
+
+                    if not args.quiet:
+                        sys.stdout.write(
+                            "".join(f"{plex_format_entry(entry)}\n" for entry in fresh)
+                        )
+
+                    with cache:
+                        cache.executemany(
+                            "INSERT OR IGNORE INTO deleted (id) VALUES (?)",
+                            [(entry.id,) for entry in fresh],
+                        )
+
+                    fresh_total += len(fresh)
+                    all_removed = all_removed and all(removed)
+
+                total += fresh_total
+
+                # That was the last page and every entry on it was just
+                # removed, there's no need to fetch an empty page to find that
+                # out. Entries skipped as already deleted may still be listed
+                # though, so look again if there were any.
+                last_page = not watch_history["pageInfo"]["hasNextPage"]
+                if last_page and all_removed and len(pending) == len(history):
                     break
 
-                except BadRequest:
-                    time.sleep(30)
+                # Either the server is slow to drop deleted entries or it
+                # won't delete some of them at all. Give it a growing amount
+                # of time to catch up, but don't keep sending the same
+                # entries forever.
+                if fresh_total == 0:
+                    stalled += 1
+                    if stalled > MAX_RETRIES:
+                        stuck = len(history)
+                        break
+
+                    time.sleep(STALL_DELAY * stalled)
+
+                else:
+                    stalled = 0
+
+    finally:
+        cache.close()
+
+    # Set the total apart from the entries listed above it, if any
+    if total and not args.quiet:
+        print()
+
+    print(f"Deleted {total} watch history entries")
+
+    if stuck:
+        sys.exit(f"Gave up on {stuck} watch history entries that are still listed")
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+
+    return number
 
 
 def main():
@@ -226,7 +320,13 @@ def main():
         help="Display all your watched movies and shows, along with the date you watched them.",
         description="Display all your watched movies and shows, along with the date you watched them.",
     )
-    parser_list.set_defaults(func=list_watch_history)
+    # Pages are fetched one at a time, so a single connection will do
+    parser_list.set_defaults(func=list_watch_history, workers=1)
+    parser_list.add_argument(
+        "--incremental",
+        help="Only display what was watched since the last incremental list.",
+        action="store_true",
+    )
 
     parser_delete = subparsers.add_parser(
         "delete",
@@ -234,6 +334,23 @@ def main():
         description="Permanently delete your entire watch history.",
     )
     parser_delete.set_defaults(func=delete_watch_history)
+    parser_delete.add_argument(
+        "--batch-size",
+        help=f"Number of entries to delete per request (default: {REMOVE_BATCH_SIZE})",
+        type=positive_int,
+        default=REMOVE_BATCH_SIZE,
+    )
+    parser_delete.add_argument(
+        "--workers",
+        help=f"Number of delete requests to have in flight at once (default: {REMOVE_WORKERS})",
+        type=positive_int,
+        default=REMOVE_WORKERS,
+    )
+    parser_delete.add_argument(
+        "--quiet",
+        help="Don't display each entry as it is deleted, which lets fewer details be fetched.",
+        action="store_true",
+    )
 
     for subparser in (parser_list, parser_delete):
         subparser.add_argument(
@@ -253,15 +370,31 @@ def main():
             default=CONFIG.get("auth.myplex_password"),
         )
 
+        subparser.add_argument(
+            "--page-size",
+            help=f"Number of watch history entries to request at a time (default: {PAGE_SIZE})",
+            type=positive_int,
+            default=PAGE_SIZE,
+        )
+
     args = parser.parse_args()
 
     if bool(args.username) != bool(args.password):
         parser.error("both username and password must be given together")
 
+    SESSION.mount("https://", https_adapter(args.workers))
+
+    # Get the TLS handshake with the community API out of the way while
+    # signing in to plex.tv, so the first real request finds a warm
+    # connection in the pool.
+    threading.Thread(target=warm_up_connection, daemon=True).start()
+
     if args.token:
         account = MyPlexAccount(token=args.token)
 
     else:
         account = getMyPlexAccount(args)
 
-    args.func(account)
+    SESSION.headers["X-Plex-Token"] = account.authenticationToken
+
+    args.func(account, args)
@@ -0,0 +1,645 @@
+import collections
+import datetime
+import email.utils
+import enum
+import functools
+import hashlib
+import json
+import queue
+import random
+import re
+import threading
+import time
+
+import requests
+from plexapi import BASE_HEADERS
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+
+COMMUNITY = "https://community.plex.tv/api"
+
+# Number of watch history entries requested per page
+PAGE_SIZE = 500
+
+# Number of pages fetched ahead of the caller
+PREFETCH_PAGES = 2
+
+# Number of removeActivity mutations merged into a single request
+REMOVE_BATCH_SIZE = 25
+
+# Number of delete batches in flight at once
+REMOVE_WORKERS = 5
+
+# Delete requests per second allowed across all workers
+REMOVE_RATE = 5
+
+# Number of times a failed request is sent again before giving up
+MAX_RETRIES = 10
+
+
+def https_adapter(workers):
+    return HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=workers,
+        pool_block=True,
+        max_retries=0,
+    )
+
+
+# All community API calls go to a single host, so keep one pooled
+# keep-alive session around instead of paying a TLS handshake per request.
+# There's a connection for each delete worker, and blocking on the pool
+# rather than overflowing it means no connection is ever opened just to be
+# thrown away after one request.
+SESSION = requests.Session()
+SESSION.mount("https://", https_adapter(REMOVE_WORKERS))
+
+SESSION.headers.update(BASE_HEADERS)
+SESSION.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+
+
+def warm_up_connection():
+    try:
+        SESSION.head(COMMUNITY, timeout=10)
+    except requests.RequestException:
+        pass
+
+
+def minify_query(query):
+    # Whitespace is only significant between names in GraphQL, and none of
+    # the queries have string literals containing any, so collapse it all
+    # to keep the query text sent with each request small.
+    query = re.sub(r"\s+", " ", query)
+    return re.sub(r" ?([{}():,=!]) ?", r"\1", query).strip()
+
+
+# Only select the fields plex_format() and the delete path actually use,
+# every extra field is resolved by the server and parsed by us per entry.
+_WATCH_HISTORY_QUERY_TEMPLATE = """\
+query GetWatchHistoryHub(
+  $uuid: ID = ""
+  $first: PaginationInt!
+  $after: String
+) {
+  user(id: $uuid) {
+    watchHistory(first: $first, after: $after) {
+      nodes {
+        metadataItem {
+          ...itemFields
+        }
+        date
+        id
+      }
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+    }
+  }
+}
+
+fragment itemFields on MetadataItem {
+%(user_state)s  title
+  type
+  index
+  parent {
+    ...parentFields
+  }
+  grandparent {
+    ...parentFields
+  }
+  year
+}
+
+fragment parentFields on MetadataItem {
+  index
+  title
+}
+"""
+
+_USER_STATE_FIELDS = """\
+  userState {
+    viewCount
+    viewedLeafCount
+    watchlistedAt
+  }
+"""
+
+# The userState selection is left out entirely rather than sent behind
+# @skip, so the server doesn't have to plan for it on every request.
+GET_WATCH_HISTORY_QUERY = minify_query(_WATCH_HISTORY_QUERY_TEMPLATE % {"user_state": ""})
+GET_WATCH_HISTORY_USER_STATE_QUERY = minify_query(
+    _WATCH_HISTORY_QUERY_TEMPLATE % {"user_state": _USER_STATE_FIELDS}
+)
+
+# Deleting only needs the ids when the entries aren't being printed
+GET_WATCH_HISTORY_IDS_QUERY = minify_query("""\
+query GetWatchHistoryHub(
+  $uuid: ID = ""
+  $first: PaginationInt!
+  $after: String
+) {
+  user(id: $uuid) {
+    watchHistory(first: $first, after: $after) {
+      nodes {
+        id
+      }
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+    }
+  }
+}
+""")
+
+
+# A watch history node flattened down to the fields we use, which is far
+# smaller to hold onto than the nested dicts the API returns.
+Entry = collections.namedtuple(
+    "Entry",
+    "id date type index title year parent_title parent_index grandparent_title user_state",
+    defaults=(None,) * 9,
+)
+
+
+def flatten_entry(node):
+    item = node["metadataItem"]
+
+    # Movies and shows come back with a null parent/grandparent, so test
+    # for that once instead of going through .get() with defaults.
+    parent = item["parent"]
+    if parent is None:
+        parent_title = parent_index = None
+    else:
+        parent_title = parent["title"]
+        parent_index = parent["index"]
+
+    grandparent = item["grandparent"]
+    grandparent_title = None if grandparent is None else grandparent["title"]
+
+    return Entry(
+        id=node["id"],
+        date=node["date"],
+        type=item["type"],
+        index=item["index"],
+        title=item["title"],
+        year=item["year"],
+        parent_title=parent_title,
+        parent_index=parent_index,
+        grandparent_title=grandparent_title,
+        user_state=item.get("userState"),
+    )
+
+
+# Automatic Persisted Queries: once the server has seen a query, later
+# requests only send its hash instead of the whole query text.
+_persisted_queries = set()
+_persisted_queries_supported = True
+
+
+@functools.lru_cache(maxsize=None)
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+_PERSISTED_QUERY_ERRORS = {
+    "PersistedQueryNotFound": "PERSISTED_QUERY_NOT_FOUND",
+    "PersistedQueryNotSupported": "PERSISTED_QUERY_NOT_SUPPORTED",
+}
+
+
+def _persisted_query_error(data):
+    for error in data.get("errors") or ():
+        code = (error.get("extensions") or {}).get("code")
+        if code in _PERSISTED_QUERY_ERRORS.values():
+            return code
+
+        if error.get("message") in _PERSISTED_QUERY_ERRORS:
+            return _PERSISTED_QUERY_ERRORS[error["message"]]
+
+    return None
+
+
+def _post(params):
+    # Content-Type is already set on the session
+    RATE_LIMIT_WATCHDOG.wait()
+    response = SESSION.post(COMMUNITY, data=json_dumps(params), timeout=30)
+    RETRY_CONTROLLER.record(response)
+    RATE_LIMIT_WATCHDOG.record(response)
+    response.raise_for_status()
+    return json_loads(response.content)
+
+
+def _post_persisted(params, rejected_unsupported=True):
+    """Post params, returning the response and any persisted query error in it."""
+    try:
+        data = _post(params)
+
+    except requests.HTTPError as e:
+        # Servers with persisted queries turned off may reject the extension
+        # outright rather than answering with an error.
+        if e.response is None or e.response.status_code != 400 or not rejected_unsupported:
+            raise
+
+        return None, "PERSISTED_QUERY_NOT_SUPPORTED"
+
+    return data, _persisted_query_error(data)
+
+
+def _post_without_persisted_queries(params):
+    global _persisted_queries_supported
+
+    data = _post(params)
+
+    # Only stop sending the extension once a request without it went
+    # through, a 400 could just as well have been about the query itself.
+    _persisted_queries_supported = False
+    return data
+
+
+def _persisted_query(params):
+    sha256 = query_hash(params["query"])
+    extensions = {"persistedQuery": {"version": 1, "sha256Hash": sha256}}
+
+    if sha256 in _persisted_queries:
+        hashed = {key: value for key, value in params.items() if key != "query"}
+        hashed["extensions"] = extensions
+
+        data, error = _post_persisted(hashed)
+        if error is None:
+            return data
+
+        # The server either forgot the query, in which case sending it in
+        # full registers it again, or doesn't do persisted queries at all.
+        _persisted_queries.discard(sha256)
+        if error == "PERSISTED_QUERY_NOT_SUPPORTED":
+            return _post_without_persisted_queries(params)
+
+    # Once the server has taken a full query with the extension, a 400 for
+    # another one is down to the query rather than the extension.
+    data, error = _post_persisted(
+        {**params, "extensions": extensions}, rejected_unsupported=not _persisted_queries
+    )
+    if error == "PERSISTED_QUERY_NOT_SUPPORTED":
+        return _post_without_persisted_queries(params)
+
+    if not data.get("errors"):
+        _persisted_queries.add(sha256)
+
+    return data
+
+
+def community_query(params, limiter=None):
+    # Transient failures are retried here, a bounded number of times, so
+    # callers only ever see errors that retrying didn't or couldn't fix.
+    # With a limiter, the request waits its turn and a retry delay holds
+    # off everyone sharing it rather than just this caller.
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            if _persisted_queries_supported:
+                return _persisted_query(params)
+
+            return _post(params)
+
+        except requests.RequestException as e:
+            if classify_error(e) is not Action.RETRY or attempt == MAX_RETRIES:
+                raise
+
+            delay = RETRY_CONTROLLER.delay(e, attempt)
+            if limiter is not None:
+                limiter.backoff(delay)
+            else:
+                time.sleep(delay)
+
+
+def retry_after(response):
+    """Seconds the server asked us to wait in its Retry-After header, if any."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        now = datetime.datetime.now(retry_at.tzinfo)
+        return max(0.0, (retry_at - now).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryController:
+    """Picks retry delays based on how congested the server appears to be.
+
+    Every response feeds an exponentially weighted moving average of the
+    share that were throttled. While that share is low a failed request is
+    retried quickly, and as it climbs every client-side retry backs off
+    further, instead of each request blindly doubling its own delay.
+    """
+
+    def __init__(self, base=2.0, cap=60.0, weight=0.2):
+        self.base = base
+        self.cap = cap
+        self.weight = weight
+        self.congestion = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, response):
+        throttled = response.status_code in (429, 503)
+
+        with self._lock:
+            self.congestion += self.weight * (throttled - self.congestion)
+
+    def delay(self, error, attempt):
+        # The server knows best when it gives an explicit answer
+        delay = retry_after(error.response)
+        if delay is not None:
+            return delay
+
+        with self._lock:
+            congestion = min(self.congestion, 0.95)
+
+        # Grows linearly with the attempt, and by up to 20x under congestion
+        delay = self.base * (attempt + 1) / (1 - congestion)
+        return min(self.cap, delay) + random.uniform(0, self.base)
+
+
+RETRY_CONTROLLER = RetryController()
+
+
+class Action(enum.IntEnum):
+    """What to do about a failed request."""
+
+    # Send the same request again, it may well succeed next time
+    RETRY = 0
+    # The server rejected this request, a smaller one may still go through
+    SKIP = 1
+    # Nothing the client can change will make it succeed
+    ABORT = 2
+
+
+_STATUS_ACTIONS = {
+    400: Action.SKIP,
+    408: Action.RETRY,
+    429: Action.RETRY,
+}
+
+
+def classify_error(error):
+    # Dropped connections, timeouts, throttling and server errors are
+    # transient, but any other 4xx (bad credentials, a missing endpoint)
+    # will fail the same way every time.
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return Action.RETRY
+
+    if error.response is None:
+        return Action.ABORT
+
+    status = error.response.status_code
+    if status >= 500:
+        return Action.RETRY
+
+    return _STATUS_ACTIONS.get(status, Action.ABORT)
+
+
+class RateLimiter:
+    """Spaces out calls to acquire() across threads to at most rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+
+        time.sleep(start - now)
+
+    def backoff(self, delay):
+        """Hold off every caller, not just the one that got rate limited."""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + delay)
+
+
+def rate_limit_reset(response):
+    """Seconds until the server's rate limit window resets, if it says."""
+    try:
+        reset = float(response.headers["X-RateLimit-Reset"])
+    except (KeyError, TypeError, ValueError):
+        return retry_after(response)
+
+    # Some servers send the time of the reset rather than the wait
+    now = time.time()
+    if reset > now / 2:
+        reset -= now
+
+    return max(0.0, reset)
+
+
+class RateLimitWatchdog:
+    """Holds requests back once the server reports its rate limit used up.
+
+    Nothing is paced while the server has requests to spare. Once a response
+    says there are none left, every request waits for the window to reset
+    and is then spaced out to at most rate per second, until a response
+    reports headroom again.
+    """
+
+    def __init__(self, rate=10, reset=1.0):
+        self.limiter = RateLimiter(rate)
+        self.reset = reset
+        self.exhausted = False
+
+    def wait(self):
+        if self.exhausted:
+            self.limiter.acquire()
+
+    def record(self, response):
+        try:
+            remaining = int(response.headers["X-RateLimit-Remaining"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        self.exhausted = remaining <= 0
+        if self.exhausted:
+            reset = rate_limit_reset(response)
+            self.limiter.backoff(self.reset if reset is None else reset)
+
+
+RATE_LIMIT_WATCHDOG = RateLimitWatchdog()
+
+
+def get_watch_history_page(params, shrink=True):
+    try:
+        response = community_query(params)
+
+    except requests.RequestException as e:
+        first = params["variables"]["first"]
+
+        # The page size may be more than the server is willing to return.
+        # Once a page has come back at this size, the 400 has to be about
+        # something else and halving won't help.
+        if not shrink or classify_error(e) is not Action.SKIP or first == 1:
+            raise
+
+        params["variables"]["first"] = first // 2
+        return get_watch_history_page(params)
+
+    return response["data"]["user"]["watchHistory"]
+
+
+def _offer(pages, item, stop):
+    # Don't block forever on a full queue once the caller has stopped
+    # reading from it.
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _prefetch_watch_history(params, all_, until, pages, stop):
+    shrink = True
+
+    try:
+        while not stop.is_set():
+            watch_history = get_watch_history_page(params, shrink)
+            shrink = False
+            page_info = watch_history["pageInfo"]
+            entries = [flatten_entry(node) for node in watch_history["nodes"]]
+
+            # Stop here rather than in the caller so no pages are fetched
+            # ahead past the point the caller was going to stop at anyway.
+            reached = False
+            if until is not None:
+                for i, entry in enumerate(entries):
+                    if until(entry):
+                        entries = entries[:i]
+                        reached = True
+                        break
+
+            if not _offer(pages, (entries, None), stop):
+                return
+
+            if reached or not all_ or not page_info["hasNextPage"]:
+                break
+
+            # No pause between pages, the retry controller backs off once
+            # the server actually starts rate limiting us.
+            params["variables"]["after"] = page_info["endCursor"]
+
+    except Exception as e:
+        _offer(pages, (None, e), stop)
+        return
+
+    _offer(pages, (None, None), stop)
+
+
+def watch_history_params(account, first=PAGE_SIZE, after=None, user_state=False, query=None):
+    if query is None:
+        query = GET_WATCH_HISTORY_USER_STATE_QUERY if user_state else GET_WATCH_HISTORY_QUERY
+
+    return {
+        "query": query,
+        "operationName": "GetWatchHistoryHub",
+        "variables": {
+            "uuid": account.uuid,
+            "first": first,
+            "after": after,
+        },
+    }
+
+
+def get_watch_history(
+    account, first=PAGE_SIZE, after=None, user_state=False, all_=True, query=None, until=None
+):
+    params = watch_history_params(account, first, after, user_state, query)
+
+    # Fetch the following pages in the background while the caller is still
+    # working through the current one. The cursor for page N + 1 is only
+    # known once page N arrives, so pages are still requested one at a time,
+    # but a slow caller no longer holds up the requests.
+    pages = queue.Queue(maxsize=PREFETCH_PAGES)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_prefetch_watch_history,
+        args=(params, all_, until, pages, stop),
+        daemon=True,
+    )
+    thread.start()
+
+    try:
+        while True:
+            nodes, error = pages.get()
+            if error is not None:
+                raise error
+
+            if nodes is None:
+                return
+
+            yield from nodes
+
+    finally:
+        # Let the prefetch thread go if the caller stopped early
+        stop.set()
+
+
+@functools.lru_cache(maxsize=None)
+def _remove_watch_history_batch_query(size):
+    # Merge one aliased removeActivity per item into a single mutation so a
+    # whole batch costs one round-trip. Only the ids change from batch to
+    # batch, so the text and alias names are built once per batch size.
+    variables = ", ".join(f"$i{i}: RemoveActivityInput!" for i in range(size))
+    mutations = " ".join(f"r{i}: removeActivity(input: $i{i})" for i in range(size))
+
+    query = minify_query(f"mutation removeActivities({variables}) {{ {mutations} }}")
+    return query, [f"i{i}" for i in range(size)], [f"r{i}" for i in range(size)]
+
+
+def build_batched_remove_mutation(ids):
+    query, inputs, aliases = _remove_watch_history_batch_query(len(ids))
+
+    params = {
+        "query": query,
+        "operationName": "removeActivities",
+        "variables": {
+            name: {
+                "id": id_,
+                "type": "WATCH_HISTORY",
+            }
+            for name, id_ in zip(inputs, ids)
+        },
+    }
+
+    return params, aliases
+
+
+def remove_watch_history_batch(items, limiter=None):
+    params, aliases = build_batched_remove_mutation([item.id for item in items])
+
+    data = community_query(params, limiter)["data"]
+    return [data[alias] for alias in aliases]
@@ -0,0 +1,67 @@
+import datetime
+import functools
+
+
+def _format_season(entry):
+    return f"{entry.parent_title}: Season {entry.index}"
+
+
+def _format_episode(entry):
+    return (
+        f"{entry.grandparent_title}: Season {entry.parent_index}: "
+        f"Episode {entry.index:2d} - {entry.title}"
+    )
+
+
+def _format_item(entry):
+    return f"{entry.title} ({entry.year})"
+
+
+# Keyed by the API's MetadataType enum values as returned, so there's no
+# need to normalize the type of every entry before dispatching on it.
+_FORMATTERS = {
+    "SEASON": _format_season,
+    "EPISODE": _format_episode,
+}
+
+
+def plex_format(entry):
+    return _FORMATTERS.get(entry.type, _format_item)(entry)
+
+
+_fromisoformat = datetime.datetime.fromisoformat
+
+_WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = (None, "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def format_date(date):
+    # The same layout as the C locale's %c (with a zero padded day), built
+    # directly from the fields rather than having strftime parse a format
+    # string and go through the locale for every entry.
+    return (
+        f"{_WEEKDAYS[date.weekday()]} {_MONTHS[date.month]} {date.day:02d} "
+        f"{date.hour:02d}:{date.minute:02d}:{date.second:02d} {date.year}"
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_day(day):
+    date = _fromisoformat(day)
+    return f"{_WEEKDAYS[date.weekday()]} {_MONTHS[date.month]} {date.day:02d} ", f" {date.year}"
+
+
+def format_iso_date(iso):
+    # Entries cluster on the same days, so cache the formatted day and
+    # splice in the time of day straight from "YYYY-MM-DDTHH:MM:SS...".
+    # format_date() only uses the fields as written, so this gives the same
+    # result without parsing the whole timestamp each time.
+    if len(iso) >= 19 and iso[10] in "T " and iso[13] == iso[16] == ":":
+        day, year = _format_day(iso[:10])
+        return f"{day}{iso[11:19]}{year}"
+
+    return format_date(_fromisoformat(iso))
+
+
+def plex_format_entry(entry):
+    return f"{format_iso_date(entry.date)}: {plex_format(entry)}"